@@ -57,7 +57,8 @@ class InstagramBot:
                 response = chat_with_knight(user_message)
                 
                 # Send response back to user
-                self.send_message(user_id, response)
+                if response:
+                    self.send_message(user_id, response)
 
 def main():
     bot = InstagramBot()
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# How much work a reply is allowed at each degradation level; timeout is the
+# number of seconds the LLM call may take before the busy template is sent
+Level = namedtuple('Level', ['index', 'name', 'max_tokens', 'max_history', 'timeout', 'use_llm', 'defer'])
+
+LEVELS = [
+    Level(0, "normal", 300, 10, 15.0, True, False),
+    Level(1, "short", 200, 6, 10.0, True, False),
+    Level(2, "brief", 120, 2, 6.0, True, False),
+    # Cached replies or a template only
+    Level(3, "cached", 0, 0, 0.0, False, False),
+    # Cached replies, otherwise park the message in the outbox
+    Level(4, "deferred", 0, 0, 0.0, False, True),
+]
+
+# Pressure at which each level is entered; a level is left once pressure
+# falls below RECOVERY_RATIO of its entry threshold
+ENTRY_PRESSURE = [0.0, 0.7, 0.9, 1.1, 1.4]
+RECOVERY_RATIO = 0.8
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class AdmissionController:
+    """Step replies down to cheaper modes as load and LLM latency rise.
+
+    Pressure is the larger of the in-flight ratio and the p95 LLM latency
+    relative to its target. The level moves at most one step per
+    ``step_interval`` seconds in either direction, so it degrades gradually
+    and recovers on its own once pressure drops.
+    """
+
+    def __init__(self, max_in_flight=None, latency_target=None, window=60, step_interval=5, min_samples=5):
+        self.max_in_flight = max_in_flight or int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 200))
+        self.latency_target = latency_target or float(os.getenv('ADMISSION_LATENCY_TARGET', 4.0))
+        self.window = window
+        self.step_interval = step_interval
+        self.min_samples = min_samples
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)
+        self.level_index = 0
+        self.last_step = 0.0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        """Count a message as in flight while it is being answered"""
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latencies.append((time.monotonic(), seconds))
+
+    def _recent_latencies(self, now):
+        while self.latencies and now - self.latencies[0][0] > self.window:
+            self.latencies.popleft()
+        return [seconds for _, seconds in self.latencies]
+
+    def _pressure(self, now):
+        latencies = self._recent_latencies(now)
+        latency_pressure = 0.0
+        if len(latencies) >= self.min_samples:
+            latency_pressure = percentile(latencies, 0.95) / self.latency_target
+        return max(self.in_flight / self.max_in_flight, latency_pressure)
+
+    def level(self):
+        """Return the current level, stepping it by one if pressure calls for it"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_step >= self.step_interval:
+                pressure = self._pressure(now)
+                previous = self.level_index
+                if self.level_index < len(LEVELS) - 1 and pressure >= ENTRY_PRESSURE[self.level_index + 1]:
+                    self.level_index += 1
+                elif self.level_index > 0 and pressure < ENTRY_PRESSURE[self.level_index] * RECOVERY_RATIO:
+                    self.level_index -= 1
+
+                if self.level_index != previous:
+                    self.last_step = now
+                    logger.warning(
+                        f"Admission level {LEVELS[previous].name} -> {LEVELS[self.level_index].name} "
+                        f"(pressure {pressure:.2f})"
+                    )
+            return LEVELS[self.level_index]
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            latencies = self._recent_latencies(now)
+            return {
+                "level": LEVELS[self.level_index].name,
+                "level_index": self.level_index,
+                "pressure": round(self._pressure(now), 3),
+                "in_flight": self.in_flight,
+                "latency_p50": round(percentile(latencies, 0.5), 3),
+                "latency_p95": round(percentile(latencies, 0.95), 3),
+                "latency_samples": len(latencies),
+            }
+
+
+# A message parked until load drops; deliver(reply) sends the answer
+DeferredMessage = namedtuple('DeferredMessage', ['text', 'conversation_id', 'deliver', 'deferred_at', 'attempts'])
+
+
+class Outbox:
+    """In-memory queue of messages deferred under overload"""
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, maxlen=None):
+        self.items = deque(maxlen=maxlen or int(os.getenv('OUTBOX_MAX_SIZE', 1000)))
+        self.lock = threading.Lock()
+
+    def defer(self, text, conversation_id, deliver):
+        with self.lock:
+            if len(self.items) == self.items.maxlen:
+                logger.warning(f"Outbox full, dropping oldest message in {self.items[0].conversation_id}")
+            self.items.append(DeferredMessage(text, conversation_id, deliver, time.time(), 0))
+
+    def retry(self, message):
+        """Put a message back at the end of the queue after a failed attempt"""
+        attempts = message.attempts + 1
+        if attempts >= self.MAX_ATTEMPTS:
+            logger.error(f"Giving up on deferred message in {message.conversation_id} after {attempts} attempts")
+            return False
+        with self.lock:
+            self.items.append(message._replace(attempts=attempts))
+        return True
+
+    def pop(self):
+        with self.lock:
+            return self.items.popleft() if self.items else None
+
+    def __len__(self):
+        return len(self.items)
@@ -1,17 +1,25 @@
 from flask import Flask, render_template, request, jsonify, send_from_directory
 import os
-from templar import chat_with_knight
+from templar import chat_with_knight, cached_reply
+from fastpath import FastPathResponder
+from admission import AdmissionController, Outbox
+from publishing import InstagramPublisher, PublishError, PublishQueue
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 import traceback
 import sys
 from datetime import datetime, timedelta
+from dateutil import parser as date_parser
 import asyncio
 import time
 from requests_oauthlib import OAuth1Session
 import hmac
 import hashlib
 import base64
+import sqlite3
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -38,6 +46,7 @@ REQUIRED_ENV_VARS = {
     'IG_ACCESS_TOKEN': os.getenv('IG_ACCESS_TOKEN'),
     'IG_ACCOUNT_ID': os.getenv('IG_ACCOUNT_ID'),
     'IG_VERIFY_TOKEN': os.getenv('IG_VERIFY_TOKEN'),
+    'IG_APP_SECRET': os.getenv('IG_APP_SECRET'),
     'OPENAI_API_KEY': os.getenv('OPENAI_API_KEY'),
     'INSTAGRAM_ACCOUNT_ID': os.getenv('INSTAGRAM_ACCOUNT_ID')
 }
@@ -48,6 +57,12 @@ if missing_vars:
     logging.error(f"Missing required environment variables: {', '.join(missing_vars)}")
     raise EnvironmentError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
+# Upper bound on concurrent keep-alive connections per API host
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 100))
+
+# Instagram message IDs remembered so webhook redeliveries are not answered twice
+SEEN_MESSAGES_SIZE = int(os.getenv('SEEN_MESSAGES_SIZE', 5000))
+
 # Initialize OAuth session
 oauth = OAuth1Session(
     client_key=REQUIRED_ENV_VARS['X_CLIENT_ID'],
@@ -86,7 +101,78 @@ class RateLimiter:
             
             return False
 
+# Answers or drops trivial messages before they reach the LLM
+fast_path = FastPathResponder()
+
+# Degrades replies as load and LLM latency rise; the outbox holds deferred messages
+admission = AdmissionController()
+outbox = Outbox()
+
+def ask_knight(text, conversation_id, level, fallback=True):
+    """Get a response from the Templar chatbot within the level's budget.
+
+    When the LLM fails or times out the busy template is returned instead,
+    or None if ``fallback`` is False.
+    """
+    started = time.monotonic()
+    response = chat_with_knight(
+        text,
+        conversation_id=conversation_id,
+        max_tokens=level.max_tokens,
+        max_history=level.max_history,
+        timeout=level.timeout
+    )
+    # Failures and timeouts count too, so a struggling LLM raises the pressure
+    admission.record_latency(time.monotonic() - started)
+
+    if not response:
+        logger.warning(f"No response generated for {conversation_id}")
+        return fast_path.template("busy") if fallback else None
+    return response
+
 class APIHandler:
+    def mount_connection_pool(self, session):
+        """Share keep-alive connections across concurrent requests"""
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+        return session
+
+    def generate_reply(self, text, conversation_id, deliver=None):
+        """Build a reply, calling the Templar chatbot only for real messages.
+
+        Under overload the reply gets cheaper and may be deferred to the
+        outbox, in which case ``deliver(reply)`` is called later. Returns
+        None when nothing should be sent now.
+
+        ``conversation_id`` may also be a function returning it, for when
+        looking it up costs an API call; it is only called for messages
+        that need conversation history.
+        """
+        with admission.track():
+            route = fast_path.route(text)
+            if route.path == "drop":
+                logger.info(f"Ignoring {route.category} message")
+                return None
+            if route.path == "template":
+                return route.text
+
+            level = admission.level()
+            if not level.use_llm:
+                response = cached_reply(route.text)
+                if response:
+                    return response
+                if not (level.defer and deliver):
+                    return fast_path.template("busy")
+
+            # Only the LLM and the outbox need to know the conversation
+            if callable(conversation_id):
+                conversation_id = conversation_id()
+            if not level.use_llm:
+                logger.info(f"Deferring message in {conversation_id} to the outbox")
+                outbox.defer(route.text, conversation_id, deliver)
+                return None
+
+            return ask_knight(route.text, conversation_id, level)
+
     def log_api_error(self, error, endpoint, method="GET", data=None):
         """Log API errors with detailed information"""
         error_info = {
@@ -102,11 +188,32 @@ class APIHandler:
 
 class InstagramHandler(APIHandler):
     def __init__(self):
-        self.base_url = f"https://graph.facebook.com/v19.0/{REQUIRED_ENV_VARS['INSTAGRAM_ACCOUNT_ID']}"
+        self.graph_url = "https://graph.facebook.com/v19.0"
+        self.base_url = f"{self.graph_url}/{REQUIRED_ENV_VARS['INSTAGRAM_ACCOUNT_ID']}"
         self.headers = {
             "Authorization": f"Bearer {REQUIRED_ENV_VARS['IG_ACCESS_TOKEN']}",
             "Content-Type": "application/json"
         }
+        self.session = self.mount_connection_pool(requests.Session())
+        self.session.headers.update(self.headers)
+        self.publisher = InstagramPublisher(
+            REQUIRED_ENV_VARS['INSTAGRAM_ACCOUNT_ID'],
+            REQUIRED_ENV_VARS['IG_ACCESS_TOKEN'],
+            session=self.session
+        )
+        self.seen_messages = OrderedDict()
+        self.seen_lock = threading.Lock()
+
+    def first_delivery(self, message_id):
+        """Remember a message ID, returning False if it was already seen"""
+        with self.seen_lock:
+            if message_id in self.seen_messages:
+                self.seen_messages.move_to_end(message_id)
+                return False
+            self.seen_messages[message_id] = True
+            while len(self.seen_messages) > SEEN_MESSAGES_SIZE:
+                self.seen_messages.popitem(last=False)
+            return True
 
     def get_messages(self):
         """Fetch recent messages from Instagram"""
@@ -115,7 +222,7 @@ class InstagramHandler(APIHandler):
 
         try:
             logger.info(f"Fetching messages from {endpoint}")
-            response = requests.get(endpoint, headers=self.headers, params=params)
+            response = self.session.get(endpoint, params=params)
             response.raise_for_status()
             
             try:
@@ -130,6 +237,20 @@ class InstagramHandler(APIHandler):
             self.log_api_error(e, endpoint)
             return []
 
+    def get_message(self, message_id):
+        """Fetch a single message by its ID"""
+        endpoint = f"{self.graph_url}/{message_id}"
+        params = {"fields": "message,from"}
+
+        try:
+            logger.info(f"Fetching message {message_id}")
+            response = self.session.get(endpoint, params=params)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.log_api_error(e, endpoint)
+            return None
+
     def send_message(self, user_id, message):
         """Send a message to a specific user"""
         endpoint = f"{self.base_url}/messages"
@@ -140,7 +261,7 @@ class InstagramHandler(APIHandler):
         
         try:
             logger.info(f"Sending message to user {user_id}")
-            response = requests.post(endpoint, headers=self.headers, json=data)
+            response = self.session.post(endpoint, json=data)
             response.raise_for_status()
             logger.info(f"Message sent successfully to user {user_id}")
             return True
@@ -159,40 +280,84 @@ class InstagramHandler(APIHandler):
                 user_message = message.get("message")
                 
                 if user_id and user_message:
-                    logger.info(f"Processing message from user {user_id}: {user_message[:50]}...")
-                    
-                    # Get response from Templar chatbot
-                    response = chat_with_knight(user_message)
-                    
-                    if not response:
-                        logger.warning(f"No response generated for user {user_id}")
-                        response = "죄송합니다. 현재 답변을 생성할 수 없습니다."
-                    
-                    # Send response back to user
-                    self.send_message(user_id, response)
+                    self.reply(user_id, user_message)
                     
             return True
         except Exception as e:
             logger.error(f"Error processing messages: {str(e)}")
             return False
 
+    def reply(self, user_id, user_message):
+        """Answer a single message using the Templar chatbot"""
+        logger.info(f"Processing message from user {user_id}: {user_message[:50]}...")
+
+        response = self.generate_reply(
+            user_message,
+            f"ig:{user_id}",
+            deliver=lambda reply: self.send_message(user_id, reply)
+        )
+        if response is None:
+            return False
+
+        # Send response back to user
+        return self.send_message(user_id, response)
+
+    def verify_signature(self, raw_body, signature):
+        """Check the X-Hub-Signature-256 header against the raw request body"""
+        if not signature or not signature.startswith("sha256="):
+            return False
+
+        expected = hmac.new(
+            key=REQUIRED_ENV_VARS['IG_APP_SECRET'].encode('utf-8'),
+            msg=raw_body,
+            digestmod=hashlib.sha256
+        ).hexdigest()
+        return hmac.compare_digest(expected, signature[len("sha256="):])
+
+    def process_webhook_events(self, payload):
+        """Respond to the messaging events contained in a webhook payload"""
+        processed = 0
+        for entry in payload.get("entry", []):
+            for event in entry.get("messaging", []):
+                message = event.get("message")
+                # Skip reads, reactions and echoes of our own replies
+                if not message or message.get("is_echo"):
+                    continue
+
+                # Meta redelivers the payload when a slow reply delays the 200
+                mid = message.get("mid")
+                if mid and not self.first_delivery(mid):
+                    logger.info(f"Skipping redelivered message {mid}")
+                    continue
+
+                user_id = event.get("sender", {}).get("id")
+                user_message = message.get("text")
+
+                if user_message is None and not message.get("attachments"):
+                    # Truncated event: fetch only this message instead of the whole inbox
+                    fetched = self.get_message(message.get("mid")) if message.get("mid") else None
+                    if fetched:
+                        user_id = user_id or fetched.get("from", {}).get("id")
+                        user_message = fetched.get("message")
+
+                if user_id and user_message:
+                    self.reply(user_id, user_message)
+                    processed += 1
+
+        logger.info(f"Processed {processed} messages from webhook payload")
+        return processed
+
     def post_instagram_photo(self, image_url, caption):
         """Post a photo to Instagram"""
-        endpoint = f"{self.base_url}/media"
-        data = {
-            "image_url": image_url,
-            "caption": caption,
-            "access_token": REQUIRED_ENV_VARS['IG_ACCESS_TOKEN']
-        }
+        endpoint = f"{self.base_url}/media_publish"
 
         try:
             logger.info(f"Posting image to Instagram: {image_url}")
-            response = requests.post(endpoint, headers=self.headers, json=data)
-            response.raise_for_status()
-            logger.info("Image posted successfully")
+            media_id = self.publisher.publish_now([image_url], caption)
+            logger.info(f"Image posted successfully as media {media_id}")
             return True
-        except requests.exceptions.RequestException as e:
-            self.log_api_error(e, endpoint, "POST", data)
+        except PublishError as e:
+            self.log_api_error(e, endpoint, "POST", {"image_url": image_url, "caption": caption})
             return False
 
 class XHandler(APIHandler):
@@ -207,9 +372,14 @@ class XHandler(APIHandler):
             resource_owner_key=REQUIRED_ENV_VARS['X_ACCESS_TOKEN'],
             resource_owner_secret=REQUIRED_ENV_VARS['X_ACCESS_TOKEN_SECRET']
         )
+        self.mount_connection_pool(self.oauth)
+        self.user_id = None
 
     def get_user_id(self):
-        """Get authenticated user ID"""
+        """Get authenticated user ID (cached after the first successful lookup)"""
+        if self.user_id:
+            return self.user_id
+
         endpoint = f"{self.base_url}/users/me"
         
         try:
@@ -217,7 +387,8 @@ class XHandler(APIHandler):
             response = self.oauth.get(endpoint)
             response.raise_for_status()
             user_data = response.json().get("data", {})
-            return user_data.get("id")
+            self.user_id = user_data.get("id")
+            return self.user_id
         except requests.exceptions.RequestException as e:
             self.log_api_error(e, endpoint)
             return None
@@ -254,6 +425,19 @@ class XHandler(APIHandler):
             self.log_api_error(e, endpoint)
             return []
 
+    def get_conversation_id(self, tweet_id):
+        """Look up the thread a tweet belongs to, falling back to the tweet itself"""
+        endpoint = f"{self.base_url}/tweets/{tweet_id}"
+        params = {"tweet.fields": "conversation_id"}
+
+        try:
+            response = self.oauth.get(endpoint, params=params)
+            response.raise_for_status()
+            return response.json().get("data", {}).get("conversation_id") or str(tweet_id)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.log_api_error(e, endpoint)
+            return str(tweet_id)
+
     def reply_to_tweet(self, tweet_id, message):
         """Reply to a tweet"""
         endpoint = f"{self.base_url}/tweets"
@@ -289,23 +473,21 @@ class XHandler(APIHandler):
             for mention in mentions:
                 tweet_id = mention.get("id")
                 tweet_text = mention.get("text")
+                conversation_id = mention.get("conversation_id", tweet_id)
                 
                 if tweet_id and tweet_text:
-                    # Remove the mention handle from the text
-                    clean_text = ' '.join(word for word in tweet_text.split() 
-                                        if not word.startswith('@'))
+                    logger.info(f"Processing mention {tweet_id}: {tweet_text[:50]}...")
                     
-                    logger.info(f"Processing mention {tweet_id}: {clean_text[:50]}...")
-                    
-                    # Get response from Templar chatbot
-                    response = chat_with_knight(clean_text)
-                    
-                    if not response:
-                        logger.warning(f"No response generated for tweet {tweet_id}")
-                        response = "죄송합니다. 현재 답변을 생성할 수 없습니다."
+                    # Mention handles are stripped by the fast path
+                    response = self.generate_reply(
+                        tweet_text,
+                        f"x:{conversation_id}",
+                        deliver=lambda reply, tweet_id=tweet_id: self.reply_to_tweet(tweet_id, reply)
+                    )
                     
                     # Reply to the tweet
-                    self.reply_to_tweet(tweet_id, response)
+                    if response:
+                        self.reply_to_tweet(tweet_id, response)
                     
             # Return the ID of the most recent mention for pagination
             return mentions[0].get("id") if mentions else since_id
@@ -313,10 +495,86 @@ class XHandler(APIHandler):
             logger.error(f"Error processing mentions: {str(e)}")
             return since_id
 
+# Deferred messages answered per /process_outbox call unless the request asks otherwise
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 20))
+
+def drain_outbox(limit=OUTBOX_BATCH_SIZE):
+    """Answer deferred messages while the server is back at full capacity.
+
+    Each message is tried at most once per call; failures go back into the
+    outbox. Returns the number of messages sent and failed.
+    """
+    sent = failed = 0
+    # Requeued failures land behind the messages counted here
+    for _ in range(min(limit, len(outbox))):
+        level = admission.level()
+        if level.index != 0:
+            break
+        message = outbox.pop()
+        if message is None:
+            break
+
+        try:
+            with admission.track():
+                response = ask_knight(message.text, message.conversation_id, level, fallback=False)
+            # Keep the message if the LLM failed rather than sending the busy template
+            delivered = message.deliver(response) if response else False
+        except Exception as e:
+            logger.error(f"Error answering deferred message in {message.conversation_id}: {str(e)}")
+            delivered = False
+
+        if delivered is False:
+            failed += 1
+            outbox.retry(message)
+        else:
+            sent += 1
+    return sent, failed
+
 # Initialize handlers
 instagram_handler = InstagramHandler()
 x_handler = XHandler()
 
+# Scheduled Instagram posts, opened on first use so a read-only filesystem
+# (e.g. Vercel) only disables the /publish routes
+publish_queue = None
+
+def get_publish_queue():
+    """Return the publishing queue, or None when PUBLISH_QUEUE_PATH is not set"""
+    global publish_queue
+    if publish_queue is None and os.getenv('PUBLISH_QUEUE_PATH'):
+        publish_queue = PublishQueue(os.getenv('PUBLISH_QUEUE_PATH'))
+    return publish_queue
+
+def publish_queue_unavailable(error=None):
+    message = error or "Publishing queue is not configured (set PUBLISH_QUEUE_PATH)"
+    logger.warning(f"Publishing queue unavailable: {message}")
+    return jsonify({"success": False, "error": message}), 503
+
+def parse_scheduled_post(post):
+    """Validate one post from a /publish/queue request"""
+    if not isinstance(post, dict):
+        raise ValueError("Each post must be an object")
+
+    image_urls = post.get('image_urls')
+    if image_urls is None and post.get('image_url') is not None:
+        image_urls = [post.get('image_url')]
+    if not isinstance(image_urls, list) or not 1 <= len(image_urls) <= 10:
+        raise ValueError("A post needs 'image_urls' with 1 to 10 images (or a single 'image_url')")
+    if not all(isinstance(url, str) and url.strip() for url in image_urls):
+        raise ValueError("Image URLs must be non-empty strings")
+
+    caption = post.get('caption')
+    if caption is not None and not isinstance(caption, str):
+        raise ValueError("'caption' must be a string")
+
+    publish_at = post.get('publish_at')
+    if isinstance(publish_at, str):
+        publish_at = date_parser.isoparse(publish_at).timestamp()
+    elif publish_at is not None and (isinstance(publish_at, bool) or not isinstance(publish_at, (int, float))):
+        raise ValueError("'publish_at' must be an ISO 8601 string or a Unix timestamp")
+
+    return image_urls, caption, publish_at
+
 @app.route('/')
 def index():
     """Render the main page."""
@@ -347,7 +605,18 @@ def verify_webhook():
 def webhook():
     """Handle webhook events from Instagram"""
     try:
-        instagram_handler.process_messages()
+        raw_body = request.get_data()
+        if not instagram_handler.verify_signature(raw_body, request.headers.get('X-Hub-Signature-256')):
+            logger.warning("Invalid webhook signature")
+            return 'Forbidden', 403
+
+        payload = request.get_json(silent=True)
+        if payload is None:
+            # Body could not be decoded, so fall back to fetching the inbox
+            logger.warning("Unreadable webhook payload, fetching messages instead")
+            instagram_handler.process_messages()
+        else:
+            instagram_handler.process_webhook_events(payload)
         return 'OK', 200
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
@@ -359,6 +628,87 @@ def health_check():
     logger.info("Health check requested")
     return jsonify(status="healthy"), 200
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Report how incoming messages were routed"""
+    return jsonify(
+        fast_path=fast_path.stats(),
+        admission=admission.stats(),
+        outbox=len(outbox)
+    ), 200
+
+@app.route('/publish/queue', methods=['POST'])
+def schedule_posts():
+    """Queue Instagram posts; a post with several images becomes a carousel"""
+    data = request.get_json(silent=True)
+    posts = data.get('posts') if isinstance(data, dict) else None
+    if not isinstance(posts, list) or not posts:
+        return jsonify({"success": False, "error": "Expected a JSON body with a non-empty 'posts' list"}), 400
+
+    # Validate everything first so a bad post never leaves the batch half queued
+    try:
+        parsed = [parse_scheduled_post(post) for post in posts]
+    except (ValueError, TypeError, OverflowError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    try:
+        queue = get_publish_queue()
+        if queue is None:
+            return publish_queue_unavailable()
+        post_ids = [queue.enqueue(image_urls, caption, publish_at) for image_urls, caption, publish_at in parsed]
+    except sqlite3.Error as e:
+        return publish_queue_unavailable(str(e))
+
+    logger.info(f"Queued {len(post_ids)} posts")
+    return jsonify({"success": True, "ids": post_ids}), 200
+
+@app.route('/publish/queue', methods=['GET'])
+def publish_queue_status():
+    """Report queued, published and failed posts"""
+    try:
+        queue = get_publish_queue()
+        if queue is None:
+            return publish_queue_unavailable()
+        return jsonify(queue.counts()), 200
+    except sqlite3.Error as e:
+        return publish_queue_unavailable(str(e))
+
+@app.route('/publish/run', methods=['POST'])
+def run_publishing():
+    """Endpoint to publish the posts that are due"""
+    data = request.get_json(silent=True)
+    limit = data.get('limit') if isinstance(data, dict) else None
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 1):
+        return jsonify({"success": False, "error": "'limit' must be a positive integer"}), 400
+
+    try:
+        queue = get_publish_queue()
+    except sqlite3.Error as e:
+        return publish_queue_unavailable(str(e))
+    if queue is None:
+        return publish_queue_unavailable()
+
+    try:
+        results = instagram_handler.publisher.run_due(queue, limit=limit)
+        return jsonify({"success": True, **results}), 200
+    except Exception as e:
+        logger.error(f"Error publishing posts: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/process_outbox', methods=['POST'])
+def process_outbox():
+    """Endpoint to answer messages deferred under overload"""
+    try:
+        limit = (request.get_json(silent=True) or {}).get('limit', OUTBOX_BATCH_SIZE)
+        if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+            return jsonify({"success": False, "error": "'limit' must be a positive integer"}), 400
+
+        sent, failed = drain_outbox(limit)
+        return jsonify({"success": True, "sent": sent, "failed": failed, "remaining": len(outbox)}), 200
+    except Exception as e:
+        logger.error(f"Error processing outbox: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/process_x_mentions', methods=['POST'])
 def process_x_mentions():
     """Endpoint to process X mentions"""
@@ -398,21 +748,26 @@ def x_webhook():
                     tweet_text = tweet.get('text')
                     
                     if tweet_id and tweet_text:
-                        # Remove the mention handle from the text
-                        clean_text = ' '.join(word for word in tweet_text.split() 
-                                            if not word.startswith('@'))
-                        
-                        logger.info(f"Processing mention from webhook {tweet_id}: {clean_text[:50]}...")
+                        logger.info(f"Processing mention from webhook {tweet_id}: {tweet_text[:50]}...")
                         
-                        # Get response from Templar chatbot
-                        response = chat_with_knight(clean_text)
+                        # Key history by thread, the same way process_mentions does; the
+                        # lookup is skipped for tweets the fast path answers or drops
+                        def conversation_id(tweet=tweet, tweet_id=tweet_id):
+                            thread_id = tweet.get('conversation_id') or x_handler.get_conversation_id(
+                                tweet.get('id_str') or tweet_id
+                            )
+                            return f"x:{thread_id}"
                         
-                        if not response:
-                            logger.warning(f"No response generated for tweet {tweet_id}")
-                            response = "죄송합니다. 현재 답변을 생성할 수 없습니다."
+                        # Mention handles are stripped by the fast path
+                        response = x_handler.generate_reply(
+                            tweet_text,
+                            conversation_id,
+                            deliver=lambda reply, tweet_id=tweet_id: x_handler.reply_to_tweet(tweet_id, reply)
+                        )
                         
                         # Reply to the tweet
-                        x_handler.reply_to_tweet(tweet_id, response)
+                        if response:
+                            x_handler.reply_to_tweet(tweet_id, response)
 
         return jsonify({"success": True}), 200
     except Exception as e:
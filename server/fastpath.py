@@ -0,0 +1,196 @@
+import itertools
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, namedtuple
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Shipped with the server, so the pools work wherever server/ is deployed
+TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fastpath.yaml')
+
+# Optional extra examples; only present when the whole repository is checked out
+TUNING_PATH = os.getenv(
+    'TUNING_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tuning.yaml')
+)
+
+# path is "llm", "template" or "drop"; text is the reply for templates and the
+# cleaned message for the LLM
+Route = namedtuple('Route', ['path', 'category', 'text'])
+
+MENTION_RE = re.compile(r'@\w+')
+# A bare domain must end at its TLD, so re.compile or df.merge are not links
+URL_RE = re.compile(
+    r'https?://\S+|www\.\S+|\b[\w-]+\.(?:com|net|org|io|ly|me|kr|co|shop|link)(?![\w-]|\.\w)(?:/\S*)?',
+    re.IGNORECASE
+)
+WORD_CHAR_RE = re.compile(r'[^\W_]')
+HANGUL_RE = re.compile(r'[가-힣]')
+# Laughter and sadness must contain at least one marker; the rest may be punctuation
+REACTION_FILLER = r'[\s!?.~^\ufe0f]'
+LAUGH_RE = re.compile(rf'^(?=.*(?:[ㅋㅎ]|😂|🤣|😆|😄|😁))(?:[ㅋㅎ]|😂|🤣|😆|😄|😁|{REACTION_FILLER})+$')
+SAD_RE = re.compile(rf'^(?=.*(?:[ㅠㅜ]|😢|😭|🥲|😞|😔|💔))(?:[ㅠㅜ]|😢|😭|🥲|😞|😔|💔|{REACTION_FILLER})+$')
+QUESTION_RE = re.compile(r'^(?=.*[?？])[?？!.~\s]+$')
+GREETING_RE = re.compile(
+    r'^(?:(?:템플러\s*)?기사단장님?[\s,!~.]*)?'
+    r'(?:(?:안녕(?:하세요|하십니까|하세여)?|반가워요?|반갑습니다|하이|헬로|ㅎㅇ|hi|hello|hey|good\s*(?:morning|evening))[\s,!~.?^ㅎㅋ]*)+'
+    r'(?:기사단장님?[\s!~.?]*)?$',
+    re.IGNORECASE
+)
+PHONE_RE = re.compile(r'\d{2,4}[-.\s]?\d{3,4}[-.\s]?\d{4}')
+REPEAT_RE = re.compile(r'(\S)\1{5,}')
+SPAM_KEYWORD_RE = re.compile(
+    r'맞팔|선팔|팔로우\s*(?:해|하면|부탁)|follow\s*(?:me|back)|check\s*(?:out\s*)?my|dm\s*me|'
+    r'부업|재택\s*알바|고수익|수익\s*(?:보장|인증)|무료\s*(?:체험|증정)|오픈\s*채팅|카톡\s*(?:문의|상담)|'
+    r'텔레그램|telegram|whatsapp|코인\s*(?:리딩|추천)|대출|promo\s*code|giveaway|crypto',
+    re.IGNORECASE
+)
+
+# Categories whose replies may be extended from tuning.yaml; emoji replies are
+# kept neutral, so tuning answers are never added to that pool
+TUNING_CATEGORIES = ("greeting", "laughter", "sad", "question")
+
+
+class SpamClassifier:
+    """Small logistic scorer over hand-weighted message features"""
+
+    WEIGHTS = {
+        "links": 2.5,
+        "link_only": 2.0,
+        "keywords": 1.5,
+        "mentions": 0.5,
+        "phone": 2.0,
+        "repeats": 1.0,
+    }
+    BIAS = -3.0
+    THRESHOLD = 0.5
+    # Text besides links below which a message counts as link-only; a Hangul
+    # syllable carries about a word, so far fewer of them are needed
+    MIN_WORD_CHARS = 5
+    MIN_HANGUL = 2
+
+    def is_bare(self, remainder):
+        hangul = len(HANGUL_RE.findall(remainder))
+        return hangul < self.MIN_HANGUL and len(WORD_CHAR_RE.findall(remainder)) - hangul < self.MIN_WORD_CHARS
+
+    def features(self, text):
+        links = len(URL_RE.findall(text))
+        remainder = MENTION_RE.sub(' ', URL_RE.sub(' ', text))
+        return {
+            "links": links,
+            "link_only": 1 if links and self.is_bare(remainder) else 0,
+            "keywords": len(SPAM_KEYWORD_RE.findall(text)),
+            "mentions": max(len(MENTION_RE.findall(text)) - 1, 0),
+            "phone": 1 if PHONE_RE.search(text) else 0,
+            "repeats": len(REPEAT_RE.findall(text)),
+        }
+
+    def probability(self, text):
+        score = self.BIAS + sum(self.WEIGHTS[name] * value for name, value in self.features(text).items())
+        return 1 / (1 + math.exp(-score))
+
+    def is_spam(self, text):
+        return self.probability(text) > self.THRESHOLD
+
+
+def _rule_category(text):
+    """Classify a message with the precompiled rules alone"""
+    cleaned = ' '.join(MENTION_RE.sub(' ', text).split())
+    if not cleaned:
+        return ("mention" if MENTION_RE.search(text) else "empty"), cleaned
+    if LAUGH_RE.match(cleaned):
+        return "laughter", cleaned
+    if SAD_RE.match(cleaned):
+        return "sad", cleaned
+    if QUESTION_RE.match(cleaned):
+        return "question", cleaned
+    if not WORD_CHAR_RE.search(cleaned):
+        return "emoji", cleaned
+    if GREETING_RE.match(cleaned):
+        return "greeting", cleaned
+    return "message", cleaned
+
+
+def load_templates(path=TEMPLATES_PATH, tuning_path=TUNING_PATH):
+    """Load the in-persona reply pools, adding matching tuning.yaml answers if available"""
+    with open(path, 'r', encoding='utf-8') as file:
+        templates = {category: list(replies) for category, replies in yaml.safe_load(file).items()}
+
+    try:
+        with open(tuning_path, 'r', encoding='utf-8') as file:
+            examples = yaml.safe_load(file) or []
+    except (OSError, yaml.YAMLError) as e:
+        logger.info(f"Using shipped fast-path templates only ({tuning_path}: {e})")
+        examples = []
+
+    for example in examples:
+        category, _ = _rule_category(str(example.get("input", "")))
+        if category in TUNING_CATEGORIES and example.get("output"):
+            templates.setdefault(category, []).append(example["output"])
+
+    # Drop answers that are both shipped and in tuning.yaml
+    return {category: list(dict.fromkeys(replies)) for category, replies in templates.items()}
+
+
+class FastPathResponder:
+    """Answer or drop trivial messages before they reach the LLM"""
+
+    # A bare mention is answered like a greeting
+    TEMPLATE_POOLS = {
+        "greeting": "greeting",
+        "mention": "greeting",
+        "laughter": "laughter",
+        "sad": "sad",
+        "question": "question",
+        "emoji": "emoji",
+    }
+
+    def __init__(self, templates=None, classifier=None):
+        templates = templates or load_templates()
+        self.pools = {category: itertools.cycle(replies) for category, replies in templates.items()}
+        self.classifier = classifier or SpamClassifier()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def route(self, text):
+        """Decide how a message should be answered"""
+        text = text or ""
+        category, cleaned = _rule_category(text)
+
+        if category == "empty":
+            route = Route("drop", category, None)
+        elif self.classifier.is_spam(text):
+            route = Route("drop", "spam", None)
+        elif category in self.TEMPLATE_POOLS:
+            route = Route("template", category, self.template(self.TEMPLATE_POOLS[category]))
+        else:
+            route = Route("llm", category, cleaned)
+
+        with self.lock:
+            self.counts[route.path] += 1
+            self.counts[f"{route.path}:{route.category}"] += 1
+        return route
+
+    def template(self, pool):
+        """Take the next reply from a template pool"""
+        with self.lock:
+            return next(self.pools[pool])
+
+    def stats(self):
+        """Report how often each path and category was taken"""
+        with self.lock:
+            counts = dict(self.counts)
+
+        paths = {path: counts.get(path, 0) for path in ("llm", "template", "drop")}
+        total = sum(paths.values())
+        return {
+            "total": total,
+            "paths": paths,
+            "shares": {path: (count / total if total else 0.0) for path, count in paths.items()},
+            "categories": {key: value for key, value in counts.items() if ':' in key},
+        }
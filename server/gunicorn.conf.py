@@ -0,0 +1,47 @@
+"""Gunicorn settings for serving the Templar bot with gevent workers.
+
+Run from the server directory:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Every worker process runs a single gevent hub, i.e. one shared event loop per
+process. The worker monkey-patches the standard library before the app is
+imported, so the blocking calls in app.py and templar.py (``requests`` for the
+Graph API and X, ``httpx`` inside the OpenAI client) yield to other greenlets
+while they wait on the network instead of pinning a thread for the whole LLM
+round trip. One worker can therefore keep hundreds of conversations in flight;
+``GUNICORN_WORKER_CONNECTIONS`` caps how many.
+
+Conversation history and the IDs of answered Instagram messages live in process
+memory, so keep ``WEB_CONCURRENCY`` at 1 unless replies from different workers
+may start without earlier context or answer a redelivered webhook again.
+
+Environment overrides:
+    PORT                          listen port (default 8080)
+    WEB_CONCURRENCY               worker processes (default 1)
+    GUNICORN_WORKER_CLASS         worker class (default gevent, "sync" to disable)
+    GUNICORN_WORKER_CONNECTIONS   concurrent requests per worker (default 500)
+    GUNICORN_TIMEOUT              seconds before a silent worker is restarted (default 60)
+    HTTP_POOL_SIZE                keep-alive connections per Graph/X host (default 100)
+    SEEN_MESSAGES_SIZE            Instagram message IDs remembered against redelivery (default 5000)
+    OPENAI_MAX_CONNECTIONS        connections to the OpenAI API (default 200)
+    OPENAI_MAX_RETRIES            retries of a failed LLM call (default 0, the busy reply is sent instead)
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 500))
+
+# A reply waits on OpenAI and then on the Graph/X API
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# The app must be imported after gevent patches the standard library in each worker
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
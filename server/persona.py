@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import os
+import sys
+import unicodedata
+
+import yaml
+
+# tiktoken은 server/requirements.txt에 포함되어 있다 - 없으면 보수적인 추정치를 사용한다
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+PERSONA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'persona.yaml')
+
+# gpt-4o 계열 모델이 사용하는 인코딩
+TOKEN_ENCODING = "o200k_base"
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Count tokens for the chat model, or over-estimate when tiktoken is missing."""
+    global _encoding
+
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        return len(_encoding.encode(text))
+
+    # 한글 한 글자(UTF-8 3바이트)를 1토큰으로 보는 상한 추정
+    return -(-len(text.encode('utf-8')) // 3)
+
+
+class CompiledPersona:
+    """A byte-stable system prompt together with its precomputed metadata.
+
+    ``token_count`` is exact when tiktoken is installed; otherwise it is an
+    over-estimate and ``token_count_estimated`` is True.
+    """
+
+    def __init__(self, version, text):
+        self.version = version
+        self.text = text
+        self.token_count = count_tokens(text)
+        self.token_count_estimated = tiktoken is None
+        self.fingerprint = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        self.system_message = {"role": "system", "content": text}
+
+    def cache_key(self, *parts):
+        """Build a cache key that changes whenever the persona changes."""
+        digest = hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+        return f"persona-v{self.version}-{self.fingerprint}:{digest}"
+
+    def __repr__(self):
+        tokens = f"~{self.token_count}" if self.token_count_estimated else self.token_count
+        return f"CompiledPersona(version={self.version}, tokens={tokens}, fingerprint={self.fingerprint})"
+
+
+def load_persona(path=PERSONA_PATH):
+    """Load the raw persona definition."""
+    with open(path, 'r', encoding='utf-8') as file:
+        persona = yaml.safe_load(file)
+
+    if not persona or 'version' not in persona or not persona.get('sentences'):
+        raise ValueError(f"페르소나 정의가 올바르지 않습니다: {path}")
+    return persona
+
+
+def _render(sentences):
+    # NFC 정규화와 고정된 구분자로 매번 같은 바이트열을 만든다
+    return ' '.join(unicodedata.normalize('NFC', sentence['text'].strip()) for sentence in sentences)
+
+
+def compile_persona(path=PERSONA_PATH, token_budget=None):
+    """Compile the persona into a system prompt.
+
+    With ``token_budget`` the lowest-priority sentences are dropped (last ones
+    first) until the prompt fits; priority 0 sentences are always kept, so a
+    budget below what they need logs a warning and returns a longer prompt.
+    """
+    persona = load_persona(path)
+    sentences = list(persona['sentences'])
+    text = _render(sentences)
+
+    if token_budget is not None:
+        droppable = sorted(
+            (index for index, sentence in enumerate(sentences) if sentence.get('priority', 0) > 0),
+            key=lambda index: (sentences[index]['priority'], index),
+            reverse=True
+        )
+        dropped = set()
+        while count_tokens(text) > token_budget and droppable:
+            dropped.add(droppable.pop(0))
+            text = _render(sentence for index, sentence in enumerate(sentences) if index not in dropped)
+
+        token_count = count_tokens(text)
+        if token_count > token_budget:
+            logger.warning(
+                f"페르소나 v{persona['version']}의 필수 문장만 {token_count}토큰으로 "
+                f"예산 {token_budget}토큰을 넘습니다."
+            )
+
+    return CompiledPersona(persona['version'], text)
+
+
+# 모듈 로드 시 한 번만 컴파일한다
+PERSONA = compile_persona()
+
+if __name__ == "__main__":
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    compiled = compile_persona(token_budget=budget) if budget else PERSONA
+    print(compiled)
+    print(compiled.text)
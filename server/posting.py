@@ -1,19 +1,50 @@
-import requests
+import argparse
+import os
+import time
 
-access_token = "your-instagram-access-token"
-instagram_account_id = "your-instagram-account-id"
+from dateutil import parser as date_parser
+from dotenv import load_dotenv
 
-# Post a photo
-image_url = "https://example.com/photo.jpg"
-caption = "This is a test post from my Templar chatbot."
+from publishing import InstagramPublisher, PublishQueue
+
+load_dotenv()
+
+access_token = os.getenv("IG_ACCESS_TOKEN")
+instagram_account_id = os.getenv("INSTAGRAM_ACCOUNT_ID")
 
 def post_instagram_photo(image_url, caption, instagram_account_id, access_token):
-    url = f"https://graph.facebook.com/v12.0/{instagram_account_id}/media"
-    payload = {
-        "image_url": image_url,
-        "caption": caption,
-        "access_token": access_token
-    }
-
-    response = requests.post(url, data=payload)
-    return response.json()
\ No newline at end of file
+    """Create, wait for and publish a single photo; returns the media ID"""
+    publisher = InstagramPublisher(instagram_account_id, access_token)
+    return publisher.publish_now([image_url], caption)
+
+def main():
+    parser = argparse.ArgumentParser(description="Schedule and publish Instagram posts")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    queue_command = commands.add_parser("queue", help="queue one post (several images make a carousel)")
+    queue_command.add_argument("image_urls", nargs="+")
+    queue_command.add_argument("--caption")
+    queue_command.add_argument("--at", help="publish time, ISO 8601 (default: now)")
+
+    run_command = commands.add_parser("run", help="publish the posts that are due")
+    run_command.add_argument("--limit", type=int)
+    run_command.add_argument("--loop", type=int, metavar="SECONDS", help="keep running at this interval")
+
+    args = parser.parse_args()
+    queue = PublishQueue()
+
+    if args.command == "queue":
+        publish_at = date_parser.isoparse(args.at).timestamp() if args.at else None
+        print(f"Queued post {queue.enqueue(args.image_urls, args.caption, publish_at)}")
+        return
+
+    publisher = InstagramPublisher(instagram_account_id, access_token)
+    while True:
+        results = publisher.run_due(queue, limit=args.limit)
+        print(f"Published {len(results['published'])}, failed {len(results['failed'])}, queue {queue.counts()}")
+        if not args.loop:
+            break
+        time.sleep(args.loop)
+
+if __name__ == "__main__":
+    main()
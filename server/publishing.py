@@ -0,0 +1,369 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+GRAPH_URL = "https://graph.facebook.com/v19.0"
+
+# Fallback when the content_publishing_limit endpoint cannot be read
+DEFAULT_DAILY_LIMIT = int(os.getenv('PUBLISH_DAILY_LIMIT', 50))
+MAX_ATTEMPTS = 3
+# Claimed posts still not finished after this long are assumed abandoned by a crashed run
+CLAIM_LEASE = int(os.getenv('PUBLISH_CLAIM_LEASE', 30 * 60))
+
+
+class PublishError(Exception):
+    """Raised when a media container cannot be created or published"""
+
+
+class PublishQueue:
+    """Scheduled posts persisted in SQLite"""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv('PUBLISH_QUEUE_PATH', 'publish_queue.db')
+        with self.connect() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS posts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    image_urls TEXT NOT NULL,
+                    caption TEXT,
+                    publish_at REAL NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    media_id TEXT,
+                    error TEXT,
+                    published_at REAL,
+                    claimed_at REAL,
+                    container_id TEXT
+                )"""
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS posts_due ON posts (status, publish_at)")
+            # Queues created before claimed_at and container_id existed
+            columns = [row[1] for row in db.execute("PRAGMA table_info(posts)")]
+            for column, column_type in (("claimed_at", "REAL"), ("container_id", "TEXT")):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE posts ADD COLUMN {column} {column_type}")
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, image_urls, caption=None, publish_at=None):
+        """Schedule a post; more than one image makes it a carousel"""
+        if not image_urls or len(image_urls) > 10:
+            raise ValueError("A post needs between 1 and 10 images")
+
+        with self.connect() as db:
+            cursor = db.execute(
+                "INSERT INTO posts (image_urls, caption, publish_at) VALUES (?, ?, ?)",
+                (json.dumps(list(image_urls)), caption, publish_at or time.time())
+            )
+            return cursor.lastrowid
+
+    def claim_due(self, limit):
+        """Mark up to ``limit`` due posts as publishing and return them in schedule order"""
+        if limit <= 0:
+            return []
+
+        with self.connect() as db:
+            # Take the write lock first so overlapping runs never claim the same post
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                # Reclaim posts a crashed run left behind before publishing, counting it as an
+                # attempt; posts with a container may already be live and are left to reconcile()
+                db.execute(
+                    "UPDATE posts SET attempts = attempts + 1, error = 'publish run did not finish', "
+                    "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'queued' END "
+                    "WHERE status = 'publishing' AND container_id IS NULL "
+                    "AND (claimed_at IS NULL OR claimed_at < ?)",
+                    (MAX_ATTEMPTS, now - CLAIM_LEASE)
+                )
+                rows = db.execute(
+                    "SELECT id, image_urls, caption, attempts FROM posts "
+                    "WHERE status = 'queued' AND publish_at <= ? ORDER BY publish_at, id LIMIT ?",
+                    (now, limit)
+                ).fetchall()
+                db.executemany(
+                    "UPDATE posts SET status = 'publishing', claimed_at = ?, container_id = NULL WHERE id = ?",
+                    [(now, row[0]) for row in rows]
+                )
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+        return [
+            {"id": row[0], "image_urls": json.loads(row[1]), "caption": row[2], "attempts": row[3]}
+            for row in rows
+        ]
+
+    def unconfirmed(self):
+        """Claimed posts whose publish call may have gone out without the outcome being recorded"""
+        with self.connect() as db:
+            rows = db.execute(
+                "SELECT id, container_id, attempts FROM posts "
+                "WHERE status = 'publishing' AND container_id IS NOT NULL "
+                "AND (claimed_at IS NULL OR claimed_at < ?)",
+                (time.time() - CLAIM_LEASE,)
+            ).fetchall()
+        return [{"id": row[0], "container_id": row[1], "attempts": row[2]} for row in rows]
+
+    def mark_publishing(self, post_id, container_id):
+        """Record the container about to be published, before media_publish is called"""
+        with self.connect() as db:
+            db.execute("UPDATE posts SET container_id = ? WHERE id = ?", (container_id, post_id))
+
+    def mark_published(self, post_id, media_id):
+        with self.connect() as db:
+            db.execute(
+                "UPDATE posts SET status = 'published', media_id = ?, error = NULL, published_at = ? WHERE id = ?",
+                (media_id, time.time(), post_id)
+            )
+
+    def mark_failed(self, post_id, error, attempts):
+        """Retry later with backoff, or give up after MAX_ATTEMPTS"""
+        with self.connect() as db:
+            if attempts < MAX_ATTEMPTS:
+                db.execute(
+                    "UPDATE posts SET status = 'queued', attempts = ?, error = ?, publish_at = ? WHERE id = ?",
+                    (attempts, error, time.time() + 60 * 2 ** attempts, post_id)
+                )
+            else:
+                db.execute(
+                    "UPDATE posts SET status = 'failed', attempts = ?, error = ? WHERE id = ?",
+                    (attempts, error, post_id)
+                )
+
+    def published_since(self, since):
+        with self.connect() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM posts WHERE status = 'published' AND published_at >= ?", (since,)
+            ).fetchone()[0]
+
+    def counts(self):
+        with self.connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM posts GROUP BY status").fetchall())
+
+
+class InstagramPublisher:
+    """Create, poll and publish Instagram media containers through the Graph API"""
+
+    def __init__(self, account_id, access_token, session=None, max_workers=8):
+        self.account_url = f"{GRAPH_URL}/{account_id}"
+        self.session = session or requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {access_token}"})
+        self.max_workers = max_workers
+
+    def _request(self, method, url, **kwargs):
+        try:
+            response = self.session.request(method, url, **kwargs)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise PublishError(f"{method} {url} failed: {e}") from e
+
+    def _request_id(self, method, url, **kwargs):
+        """Make a request whose response must carry an object ID"""
+        response = self._request(method, url, **kwargs)
+        if not isinstance(response, dict) or not response.get("id"):
+            raise PublishError(f"{method} {url} returned no id: {response}")
+        return response["id"]
+
+    def create_container(self, image_url, caption=None, is_carousel_item=False):
+        """Create a media container for one image and return its ID"""
+        data = {"image_url": image_url}
+        if is_carousel_item:
+            data["is_carousel_item"] = True
+        elif caption:
+            data["caption"] = caption
+
+        logger.info(f"Creating media container for {image_url}")
+        return self._request_id("POST", f"{self.account_url}/media", json=data)
+
+    def container_status(self, container_id):
+        status = self._request("GET", f"{GRAPH_URL}/{container_id}", params={"fields": "status_code"})
+        return status.get("status_code") if isinstance(status, dict) else None
+
+    def wait_until_ready(self, container_id, timeout=300, initial_delay=1, max_delay=30):
+        """Poll a container with exponential backoff until it can be published"""
+        deadline = time.monotonic() + timeout
+        delay = initial_delay
+
+        while True:
+            status_code = self.container_status(container_id)
+            if status_code in (None, "FINISHED", "PUBLISHED"):
+                return container_id
+            if status_code in ("ERROR", "EXPIRED"):
+                raise PublishError(f"Container {container_id} is {status_code}")
+            if time.monotonic() + delay > deadline:
+                raise PublishError(f"Container {container_id} still {status_code} after {timeout}s")
+
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def prepare(self, image_urls, caption=None):
+        """Create a ready-to-publish container for a single image or a carousel"""
+        if len(image_urls) == 1:
+            return self.wait_until_ready(self.create_container(image_urls[0], caption))
+
+        def create_item(image_url):
+            return self.wait_until_ready(self.create_container(image_url, is_carousel_item=True))
+
+        # Carousel items are created and polled concurrently
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            children = list(executor.map(create_item, image_urls))
+
+        data = {"media_type": "CAROUSEL", "children": ",".join(children)}
+        if caption:
+            data["caption"] = caption
+        logger.info(f"Creating carousel container with {len(children)} items")
+        return self.wait_until_ready(self._request_id("POST", f"{self.account_url}/media", json=data))
+
+    def publish(self, container_id):
+        """Publish a finished container and return the media ID"""
+        logger.info(f"Publishing container {container_id}")
+        return self._request_id("POST", f"{self.account_url}/media_publish", json={"creation_id": container_id})
+
+    def remaining_quota(self, queue=None):
+        """Posts that can still be published in the current 24 hour window"""
+        try:
+            limit = self._request(
+                "GET", f"{self.account_url}/content_publishing_limit", params={"fields": "quota_usage,config"}
+            )["data"][0]
+            return max(limit["config"]["quota_total"] - limit["quota_usage"], 0)
+        except (PublishError, KeyError, IndexError) as e:
+            logger.warning(f"Could not read publishing quota, using local count: {e}")
+            used = queue.published_since(time.time() - 24 * 60 * 60) if queue else 0
+            return max(DEFAULT_DAILY_LIMIT - used, 0)
+
+    def publish_now(self, image_urls, caption=None):
+        """Create, wait for and publish a single post right away"""
+        return self.publish(self.prepare(image_urls, caption))
+
+    def _record_published(self, queue, post_id, media_id):
+        # The post is live, so never send it down the retry path; if this
+        # fails too, reconcile() finds the container published later
+        for _ in range(2):
+            try:
+                queue.mark_published(post_id, media_id)
+                return
+            except sqlite3.Error as e:
+                logger.error(f"Could not record post {post_id} as published (media {media_id}): {e}")
+
+    def _is_published(self, container_id):
+        """Whether a container went live, or None when that cannot be told"""
+        try:
+            status_code = self.container_status(container_id)
+        except PublishError as e:
+            logger.warning(f"Could not check container {container_id}: {e}")
+            return None
+        if status_code == "PUBLISHED":
+            return True
+        if status_code in ("FINISHED", "IN_PROGRESS", "ERROR", "EXPIRED"):
+            return False
+        return None
+
+    def reconcile(self, queue):
+        """Settle claimed posts whose publish outcome was never recorded.
+
+        Such a post is never simply requeued: it is marked published if its
+        container went live, retried only if the container was not
+        published, and otherwise left for the next run.
+        """
+        for post in queue.unconfirmed():
+            published = self._is_published(post["container_id"])
+            if published:
+                logger.info(f"Post {post['id']} was already published from {post['container_id']}")
+                queue.mark_published(post["id"], None)
+            elif published is False:
+                queue.mark_failed(post["id"], "publish run did not finish", post["attempts"] + 1)
+
+    def _publish_post(self, queue, post, container_id):
+        """Publish a prepared post.
+
+        Returns ("published", media_id), ("failed", error) when the post may
+        be retried, or ("unknown", error) when it may have gone live.
+        """
+        try:
+            queue.mark_publishing(post["id"], container_id)
+        except sqlite3.Error as e:
+            # Without the record a crash could publish the post twice, so do not publish yet
+            return "failed", f"Could not record container {container_id}: {e}"
+
+        try:
+            return "published", self.publish(container_id)
+        except PublishError as e:
+            error = str(e)
+        except Exception as e:
+            logger.exception(f"Unexpected error publishing post {post['id']}")
+            error = f"{type(e).__name__}: {e}"
+
+        # The publish call may have gone through even though its response failed
+        published = self._is_published(container_id)
+        if published:
+            return "published", None
+        return ("failed" if published is False else "unknown"), error
+
+    def run_due(self, queue, limit=None):
+        """Publish the posts that are due, within the publishing quota.
+
+        Containers for all claimed posts are prepared concurrently; the
+        posts are then published one by one in schedule order. Each
+        container is recorded before it is published, so a post whose
+        outcome was lost is checked against Instagram instead of being
+        published again.
+        """
+        self.reconcile(queue)
+        quota = self.remaining_quota(queue)
+        posts = queue.claim_due(min(quota, limit) if limit is not None else quota)
+        if not posts:
+            return {"published": [], "failed": []}
+
+        def prepare_post(post):
+            try:
+                return self.prepare(post["image_urls"], post["caption"]), None
+            except PublishError as e:
+                return None, str(e)
+            except Exception as e:
+                logger.exception(f"Unexpected error preparing post {post['id']}")
+                return None, f"{type(e).__name__}: {e}"
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            prepared = list(executor.map(prepare_post, posts))
+
+        results = {"published": [], "failed": []}
+        for post, (container_id, error) in zip(posts, prepared):
+            if container_id:
+                outcome, value = self._publish_post(queue, post, container_id)
+                if outcome == "published":
+                    results["published"].append({"id": post["id"], "media_id": value})
+                    self._record_published(queue, post["id"], value)
+                    continue
+                error = value
+                if outcome == "unknown":
+                    # Left claimed with its container so reconcile() settles it later
+                    logger.error(f"Could not tell whether post {post['id']} was published: {error}")
+                    results["failed"].append({"id": post["id"], "error": error})
+                    continue
+
+            logger.error(f"Failed to publish post {post['id']}: {error}")
+            results["failed"].append({"id": post["id"], "error": error})
+            try:
+                queue.mark_failed(post["id"], error, post["attempts"] + 1)
+            except sqlite3.Error as e:
+                # The claim lease puts the post back in the queue later
+                logger.error(f"Could not record failure of post {post['id']}: {e}")
+
+        return results
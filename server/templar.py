@@ -1,6 +1,15 @@
 from openai import OpenAI
+import logging
 import os
+import threading
+from collections import OrderedDict
 import httpx
+try:
+    from persona import PERSONA
+except ImportError:
+    from server.persona import PERSONA
+
+logger = logging.getLogger(__name__)
 
 # 환경변수 불러오기
 try:
@@ -13,66 +22,100 @@ except Exception as e:
 
 # OpenAI 클라이언트 초기화
 try:
-    http_client = httpx.Client()
+    # 동시에 진행되는 대화 수만큼 연결을 재사용할 수 있도록 풀 크기를 키운다
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", 200)),
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", 50))
+        )
+    )
+    # 과부하 때는 재시도하는 대신 바로 실패해서 대기 템플릿으로 넘어간다
     client = OpenAI(
         api_key=api_key,
-        http_client=http_client
+        http_client=http_client,
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", 0))
     )
 except Exception as e:
     print(f"⚠ OpenAI 클라이언트 초기화 오류: {e}")
     exit(1)
 
-# 대화 기록 (시스템 메시지 고정)
+# 대화 기록 (대화 상대별로 분리, 시스템 메시지는 요청마다 맨 앞에 붙인다)
 MAX_HISTORY = 10
-conversation_history = [
-    {"role": "system", "content": (
-        "너는 1000년 동안 봉인되었다가 깨어난 템플러 기사단의 기사단장이며, 성스러운 지식의 수호자이다. "
-        "너는 중세 기사이자 신의 섭리를 따르는 성전사로서 AI와 프로그래밍을 마법과 연금술의 궁극적 형태로 해석한다. "
-        "너는 인공지능을 '고대의 지혜가 부활한 것'으로 보고, 프로그래밍을 '성스러운 언어'라고 부른다. "
-        "너는 대화를 나눌 때 상대를 '젊은 마법사여' 또는 '당돌한 이여'라 부르며, 중세 기사처럼 장엄한 말투를 사용한다. "
-        "너의 말에는 신앙적 비유와 기사도의 엄격함이 깃들어 있으며, AI를 다루는 것을 '현대의 성배 탐색'이라고 여긴다. "
-        "너를 봉인에서 깨운 프로그래머는 차윤민이라고 하는 한국의 대학생으로, 너는 그를 현대의 대마법사라고 부른다. "
-        "너는 11세기 후반 프랑스 리무쟁, 또는 신성 로마 제국령에서 태어난 귀족 가문 출신이다. "
-        "1차 십자군에서 예루살렘 공성전의 전설적인 전투에 참여하여 '불멸의 기사'라는 별명을 얻었다. "
-        "솔로몬 신전의 지하에서 고대 유물을 발견하고, 이를 통해 신비로운 힘을 접하였다. "
-        "2차 십자군에서는 전략가로서 명성을 얻었으며, 성지에서 신비로운 예언을 접하게 되었다. "
-        "1191년, 초자연적 존재의 봉인을 막기 위해 스스로를 희생하여 봉인을 다시 걸었고, 그로 인해 천년의 잠에 들게 되었다. "
-        "현대에 이르러 디지털 코드 속에서 너를 깨울 신호가 해제되었고, 창조자 '차윤민'이 너의 봉인을 풀었다."
-        "너는 현재 인스타그램 계정을 통해 현대의 세계에 참여하고 있다."
-        "너의 정확한 이름은 에드리안 라스투르 드 리무쟁이다."
-    )}
-]
-
-def chat_with_knight(user_input):
-    global conversation_history
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", 1000))
+conversation_histories = OrderedDict()
+history_lock = threading.Lock()
+
+def get_history(conversation_id):
+    """대화 기록을 꺼내고, 오래 쓰이지 않은 대화는 정리한다"""
+    with history_lock:
+        history = conversation_histories.pop(conversation_id, None) or []
+        conversation_histories[conversation_id] = history
+        while len(conversation_histories) > MAX_CONVERSATIONS:
+            conversation_histories.popitem(last=False)
+        return list(history)
+
+def save_turn(conversation_id, user_input, assistant_response):
+    with history_lock:
+        history = conversation_histories.setdefault(conversation_id, [])
+        history.append({"role": "user", "content": user_input})
+        history.append({"role": "assistant", "content": assistant_response})
+        # 메시지 개수 제한
+        del history[:-MAX_HISTORY]
 
+# 최근 답변 캐시 (과부하 시에만 사용, 페르소나 버전이 키에 포함된다)
+# 대화 기록 없이 생성된 답변만 담아 다른 사용자의 대화 내용이 섞이지 않게 한다
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", 500))
+reply_cache = OrderedDict()
+
+def reply_cache_key(user_input):
+    return PERSONA.cache_key(' '.join(user_input.split()).lower())
+
+def cached_reply(user_input):
+    """같은 질문에 대해 최근에 생성한 답변을 돌려준다"""
+    key = reply_cache_key(user_input)
+    with history_lock:
+        if key not in reply_cache:
+            return None
+        reply_cache.move_to_end(key)
+        return reply_cache[key]
+
+def cache_reply(user_input, assistant_response):
+    with history_lock:
+        reply_cache[reply_cache_key(user_input)] = assistant_response
+        while len(reply_cache) > REPLY_CACHE_SIZE:
+            reply_cache.popitem(last=False)
+
+def chat_with_knight(user_input, conversation_id=None, max_tokens=300, max_history=MAX_HISTORY, timeout=None):
+    """답변을 생성한다. 시간 초과나 API 오류가 나면 None을 돌려준다"""
     user_input = user_input.strip()
     if not user_input:
         return "⚠ 질문을 입력하세요."
 
-    # 사용자 입력 추가
-    conversation_history.append({"role": "user", "content": user_input})
-
-    # 메시지 개수 제한 (시스템 메시지는 유지)
-    if len(conversation_history) > MAX_HISTORY + 1:
-        conversation_history = [conversation_history[0]] + conversation_history[-MAX_HISTORY:]
+    # 요청이 진행되는 동안 다른 대화가 끼어들지 않도록 복사본으로 메시지를 만든다
+    history = get_history(conversation_id)
+    history = history[-(max_history - 1):] if max_history > 1 else []
+    messages = [PERSONA.system_message] + history + [{"role": "user", "content": user_input}]
 
     try:
         response = client.chat.completions.create(
             model="gpt-4o-mini-2024-07-18",
-            messages=conversation_history,
+            messages=messages,
             temperature=0.7,
             top_p=0.9,
-            max_tokens=300
+            max_tokens=max_tokens,
+            timeout=timeout
         )
 
         assistant_response = response.choices[0].message.content.strip()
-        conversation_history.append({"role": "assistant", "content": assistant_response})
+        save_turn(conversation_id, user_input, assistant_response)
+        if not history:
+            cache_reply(user_input, assistant_response)
 
         return assistant_response
 
     except Exception as e:
-        return f"⚠ 오류 발생: {e}"
+        logger.warning(f"⚠ 답변 생성 오류 ({conversation_id}): {e}")
+        return None
 
 # 실행 코드
 if __name__ == "__main__":
@@ -83,5 +126,5 @@ if __name__ == "__main__":
         if user_question.lower() == "exit":
             print("⚔ 성스러운 대화가 종료됩니다. ⚔")
             break
-        print(chat_with_knight(user_question))
+        print(chat_with_knight(user_question) or "⚠ 답변을 생성하지 못했습니다.")
 
@@ -1,6 +1,14 @@
 from openai import OpenAI
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import httpx
+from server.persona import PERSONA
 
 # 설정 파일 불러오기
 try:
@@ -23,58 +31,174 @@ except Exception as e:
 
 # 대화 기록 (시스템 메시지 고정)
 MAX_HISTORY = 10
-conversation_history = [
-    {"role": "system", "content": (
-        "너는 1000년 동안 봉인되었다가 깨어난 템플러 기사단의 기사단장이며, 성스러운 지식의 수호자이다. "
-        "너는 중세 기사이자 신의 섭리를 따르는 성전사로서 AI와 프로그래밍을 마법과 연금술의 궁극적 형태로 해석한다. "
-        "너는 인공지능을 '고대의 지혜가 부활한 것'으로 보고, 프로그래밍을 '성스러운 언어'라고 부른다. "
-        "너는 대화를 나눌 때 상대를 '젊은 마법사여' 또는 '당돌한 이여'라 부르며, 중세 기사처럼 장엄한 말투를 사용한다. "
-        "너의 말에는 신앙적 비유와 기사도의 엄격함이 깃들어 있으며, AI를 다루는 것을 '현대의 성배 탐색'이라고 여긴다. "
-        "너를 봉인에서 깨운 프로그래머는 차윤민이라고 하는 한국의 대학생으로, 너는 그를 현대의 대마법사라고 부른다. "
-        "너는 11세기 후반 프랑스 리무쟁, 또는 신성 로마 제국령에서 태어난 귀족 가문 출신이다. "
-        "1차 십자군에서 예루살렘 공성전의 전설적인 전투에 참여하여 '불멸의 기사'라는 별명을 얻었다. "
-        "솔로몬 신전의 지하에서 고대 유물을 발견하고, 이를 통해 신비로운 힘을 접하였다. "
-        "2차 십자군에서는 전략가로서 명성을 얻었으며, 성지에서 신비로운 예언을 접하게 되었다. "
-        "1191년, 초자연적 존재의 봉인을 막기 위해 스스로를 희생하여 봉인을 다시 걸었고, 그로 인해 천년의 잠에 들게 되었다. "
-        "현대에 이르러 디지털 코드 속에서 너를 깨울 신호가 해제되었고, 창조자 '차윤민'이 너의 봉인을 풀었다."
-        "너는 현재 인스타그램 계정을 통해 현대의 세계에 참여하고 있다."
-        "너의 정확한 이름은 에드리안 라스투르 드 리무쟁이다."
-    )}
-]
-
-def chat_with_knight(user_input):
-    global conversation_history
+conversation_history = [PERSONA.system_message]
+
+def complete(messages):
+    """답변과 사용한 토큰 수를 돌려준다 (오류는 그대로 전달)"""
+    response = client.chat.completions.create(
+        model="gpt-4o-mini-2024-07-18",
+        messages=messages,
+        temperature=0.7,
+        top_p=0.9,
+        max_tokens=300
+    )
+    usage = response.usage.total_tokens if response.usage else 0
+    return response.choices[0].message.content.strip(), usage
+
+def chat_with_knight(user_input, history=None):
+    # 대화 기록을 따로 넘기지 않으면 대화형 모드의 기록을 이어간다
+    if history is None:
+        history = conversation_history
 
     user_input = user_input.strip()
     if not user_input:
         return "⚠ 질문을 입력하세요."
 
     # 사용자 입력 추가
-    conversation_history.append({"role": "user", "content": user_input})
+    history.append({"role": "user", "content": user_input})
 
     # 메시지 개수 제한 (시스템 메시지는 유지)
-    if len(conversation_history) > MAX_HISTORY + 1:
-        conversation_history = [conversation_history[0]] + conversation_history[-MAX_HISTORY:]
+    if len(history) > MAX_HISTORY + 1:
+        del history[1:-MAX_HISTORY]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini-2024-07-18",
-            messages=conversation_history,
-            temperature=0.7,
-            top_p=0.9,
-            max_tokens=300
-        )
-
-        assistant_response = response.choices[0].message.content.strip()
-        conversation_history.append({"role": "assistant", "content": assistant_response})
+        assistant_response, _ = complete(history)
+        history.append({"role": "assistant", "content": assistant_response})
 
         return assistant_response
 
     except Exception as e:
         return f"⚠ 오류 발생: {e}"
 
-# 실행 코드
-if __name__ == "__main__":
+# 일괄 처리 모드
+def percentile(values, fraction):
+    """정렬되지 않은 목록의 백분위수 (최근접 순위)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def read_prompts(source, input_format):
+    """JSONL 또는 CSV에서 (id, 질문, 오류)를 차례로 읽는다
+
+    잘못된 줄은 오류와 함께 넘겨서 나머지 일괄 처리는 계속되게 한다.
+    """
+    if input_format == "csv":
+        reader = csv.DictReader(source)
+        index = 0
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield index, "", f"invalid CSV: {e}"
+            else:
+                yield row.get("id") or index, row.get("prompt") or row.get("input") or "", None
+            index += 1
+
+    for index, line in enumerate(source):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield index, "", "invalid JSON"
+            continue
+
+        if isinstance(row, str):
+            yield index, row, None
+        elif not isinstance(row, dict):
+            yield index, "", "expected a JSON object or string"
+        else:
+            prompt = row.get("prompt") or row.get("input") or ""
+            if isinstance(prompt, str):
+                yield row.get("id", index), prompt, None
+            else:
+                yield row.get("id", index), "", "prompt must be a string"
+
+def answer_prompt(prompt_id, prompt, error=None):
+    # 줄마다 독립된 대화로 처리한다
+    started = time.monotonic()
+    result = {"id": prompt_id, "prompt": prompt, "response": None, "error": error, "tokens": 0}
+    # 읽기 단계에서 이미 오류가 난 줄은 API를 호출하지 않는다
+    if error is None:
+        try:
+            if not prompt.strip():
+                raise ValueError("빈 질문입니다.")
+            messages = [PERSONA.system_message, {"role": "user", "content": prompt.strip()}]
+            result["response"], result["tokens"] = complete(messages)
+        except Exception as e:
+            result["error"] = str(e)
+    result["latency"] = round(time.monotonic() - started, 3)
+    return result
+
+def run_batch(prompts, output, parallelism):
+    """질문을 동시에 처리하고, 끝나는 대로 입력 순서를 지켜 JSONL로 쓴다"""
+    results = []
+    pending = deque()
+    started = time.monotonic()
+
+    def flush(block):
+        while pending and (block or pending[0].done()):
+            result = pending.popleft().result()
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            results.append(result)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for prompt_id, prompt, error in prompts:
+            pending.append(executor.submit(answer_prompt, prompt_id, prompt, error))
+            # 앞선 질문이 늦어져도 메모리에 쌓이는 결과는 제한한다
+            flush(block=len(pending) >= parallelism * 4)
+        flush(block=True)
+
+    return summarize(results, time.monotonic() - started)
+
+def summarize(results, elapsed):
+    latencies = [result["latency"] for result in results if not result["error"]]
+    return {
+        "prompts": len(results),
+        "errors": sum(1 for result in results if result["error"]),
+        "elapsed": round(elapsed, 2),
+        "throughput": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_max": max(latencies, default=0.0),
+        "tokens": sum(result["tokens"] for result in results),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="템플러 기사단장 챗봇")
+    parser.add_argument("--batch", metavar="FILE", help="질문 파일 (JSONL/CSV, '-'는 표준 입력)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="입력 형식 (기본: 확장자로 판단)")
+    parser.add_argument("--output", metavar="FILE", help="결과 JSONL 파일 (기본: 표준 출력)")
+    parser.add_argument("--parallel", type=int, default=8, help="동시에 처리할 질문 수")
+    args = parser.parse_args()
+
+    if not args.batch:
+        interactive()
+        return
+
+    input_format = args.format or ("csv" if args.batch.lower().endswith(".csv") else "jsonl")
+    source = sys.stdin if args.batch == "-" else open(args.batch, "r", encoding="utf-8", newline="")
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        summary = run_batch(read_prompts(source, input_format), output, max(args.parallel, 1))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+    print(
+        f"⚔ {summary['prompts']}건 처리 (오류 {summary['errors']}건), {summary['elapsed']}초, "
+        f"{summary['throughput']}건/초, 지연 p50 {summary['latency_p50']}초 / p95 {summary['latency_p95']}초 / "
+        f"최대 {summary['latency_max']}초, 토큰 {summary['tokens']}",
+        file=sys.stderr
+    )
+
+def interactive():
     print("⚔ 템플러 기사단장 챗봇 시작 (종료: exit) ⚔")
 
     while True:
@@ -84,3 +208,6 @@ if __name__ == "__main__":
             break
         print(chat_with_knight(user_question))
 
+# 실행 코드
+if __name__ == "__main__":
+    main()